@@ -17,6 +17,10 @@ CONCURRENCY_LIMIT = 20
 SIA_DATASET = "ALL"
 SIA_MODE = "listed"
 SIA_LIMIT = 2000
+# Targets are queried in blocks of this prefix length; anything already this size or smaller
+# is queried whole. Lowering it (e.g. to 20) cuts request counts if the API accepts larger
+# blocks for your account; a block that hits SIA_LIMIT is logged with a warning.
+SPLIT_PREFIX = 24
 
 # --- History Configuration ---
 # Default number of days to look back for historical scans.
@@ -28,4 +32,6 @@ os.makedirs("output", exist_ok=True)
 DATABASE_FILE = "output/sia_scout.db"
 LOG_FILE = "output/sia_scout.log"
 TOKEN_FILE = "output/token.json"
+# One CIDR per line; blank lines and lines starting with '#' are ignored.
+# The file is loaded with a single bulk read, so very long target lists are cheap to parse.
 TARGET_FILE = "targets/cidrs.txt"
\ No newline at end of file
@@ -1,27 +1,51 @@
 # FILE: main.py
 
 import logging
+import logging.handlers
 import sys
+import queue
+import atexit
 import asyncio
 import argparse
 import config
-from sia_scout.client import AsyncSiaClient
-from sia_scout.collector import AsyncCollector
 from sia_scout.database import initialize_database
-from sia_scout.analyzer import Analyzer
-from sia_scout.visualizer import Visualizer
+
+
+class BufferedFileHandler(logging.FileHandler):
+    """A FileHandler that writes through a 64 KiB buffer and only flushes on ERROR and above."""
+
+    def _open(self):
+        return open(self.baseFilename, self.mode, encoding=self.encoding, errors=self.errors, buffering=65536)
+
+    def emit(self, record):
+        if self.stream is None:
+            if self.mode != 'w' or not self._closed: self.stream = self._open()
+            else: return
+        try:
+            self.stream.write(self.format(record) + self.terminator)
+            if record.levelno >= logging.ERROR: self.flush()
+        except Exception:
+            self.handleError(record)
 
 
 def setup_logging():
-    log_format = logging.Formatter('%(asctime)s - %(name)s - %(levelname)s - %(message)s')
+    log_format = logging.Formatter('{asctime} - {name} - {levelname} - {message}', style='{')
     root_logger = logging.getLogger()
     root_logger.setLevel(logging.INFO)
-    file_handler = logging.FileHandler(config.LOG_FILE)
+    file_handler = BufferedFileHandler(config.LOG_FILE)
     file_handler.setFormatter(log_format)
-    root_logger.addHandler(file_handler)
-    console_handler = logging.StreamHandler(sys.stdout)
-    console_handler.setFormatter(log_format)
-    root_logger.addHandler(console_handler)
+    handlers = [file_handler]
+    # Non-interactive runs (cron, CI, redirected output) already have everything in the log file.
+    if sys.stdout.isatty():
+        console_handler = logging.StreamHandler(sys.stdout)
+        console_handler.setFormatter(log_format)
+        handlers.append(console_handler)
+    # The event loop only enqueues records; a background thread does the formatting and writing.
+    log_queue = queue.SimpleQueue()
+    root_logger.addHandler(logging.handlers.QueueHandler(log_queue))
+    listener = logging.handlers.QueueListener(log_queue, *handlers, respect_handler_level=True)
+    listener.start()
+    atexit.register(listener.stop)
 
 
 async def main_async():
@@ -35,6 +59,9 @@ async def main_async():
     p_collect_hist = subparsers.add_parser('collect-history', help="Scan for HISTORICAL listings (no cache).")
     p_collect_hist.add_argument('--days', type=int, default=config.HISTORY_LOOKBACK_DAYS,
                                 help=f"Number of days to look back. Default: {config.HISTORY_LOOKBACK_DAYS}")
+    for p in (p_collect, p_collect_hist):
+        p.add_argument('--check-limits', action='store_true',
+                       help="Print the account's API limits and usage before scanning.")
     p_analyze = subparsers.add_parser('analyze', help="Analyze LIVE data from the database.")
     p_analyze_hist = subparsers.add_parser('analyze-history', help="Analyze HISTORICAL data from the database.")
     p_visualize = subparsers.add_parser('visualize', help="Visualize LIVE data.")
@@ -49,34 +76,51 @@ async def main_async():
     logger.info(f"--- SIA-Scout Initializing | Action: {args.action.upper()} ---")
     await initialize_database(config.DATABASE_FILE)
 
+    # Action-specific modules are imported inside their branch so that, e.g., a collect run
+    # never pays for importing pandas/matplotlib.
     if args.action == 'collect' or args.action == 'collect-history':
+        from sia_scout.client import AsyncSiaClient
+        from sia_scout.collector import AsyncCollector
         client = AsyncSiaClient(base_url=config.API_BASE_URL, username=config.SIA_USERNAME,
-                                password=config.SIA_PASSWORD, token_file=config.TOKEN_FILE)
-        client.check_limits_sync()
+                                password=config.SIA_PASSWORD, token_file=config.TOKEN_FILE,
+                                concurrency=config.CONCURRENCY_LIMIT)
+        await client.ensure_auth()
+        if args.check_limits: await client.check_limits()
         query_params = {'dataset': config.SIA_DATASET, 'mode': config.SIA_MODE, 'limit': config.SIA_LIMIT}
         collector = AsyncCollector(client=client, target_file=config.TARGET_FILE, db_path=config.DATABASE_FILE,
-                                   concurrency=config.CONCURRENCY_LIMIT, params=query_params)
+                                   concurrency=config.CONCURRENCY_LIMIT, params=query_params,
+                                   split_prefix=config.SPLIT_PREFIX)
         history_days = args.days if args.action == 'collect-history' else None
         await collector.run_scan(history_days=history_days)
 
     elif args.action == 'analyze':
+        from sia_scout.analyzer import Analyzer
         analyzer = Analyzer(db_path=config.DATABASE_FILE)
         await analyzer.generate_summary_report()
 
     elif args.action == 'analyze-history':
+        from sia_scout.analyzer import Analyzer
         analyzer = Analyzer(db_path=config.DATABASE_FILE)
         await analyzer.generate_history_summary_report()
 
     elif args.action == 'visualize':
+        from sia_scout.visualizer import Visualizer
         visualizer = Visualizer(db_path=config.DATABASE_FILE)
         await visualizer.generate_all_visuals()
 
     elif args.action == 'visualize-history':
+        from sia_scout.visualizer import Visualizer
         visualizer = Visualizer(db_path=config.DATABASE_FILE)
         await visualizer.generate_history_visuals()
 
 
 if __name__ == "__main__":
+    try:
+        # uvloop is optional (and unavailable on Windows); fall back to the default loop without it.
+        import uvloop
+        asyncio.set_event_loop_policy(uvloop.EventLoopPolicy())
+    except ImportError:
+        pass
     try:
         asyncio.run(main_async());
     except KeyboardInterrupt:
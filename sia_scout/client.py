@@ -4,99 +4,179 @@ import logging
 import asyncio
 import aiohttp
 import sys
-import requests
 import os
-import json
+import orjson
 import time
+import random
+import functools
 
 logger = logging.getLogger(__name__)
 
+# How many times a CIDR query is retried after a 429 before it is given up on.
+MAX_RATE_LIMIT_RETRIES = 5
+# Longest wait, in seconds, before a single retry.
+MAX_RETRY_DELAY = 60.0
+
+
+class RateLimitExceeded(Exception):
+    """Raised when a CIDR query is still rate-limited after MAX_RATE_LIMIT_RETRIES retries."""
+
+
+@functools.lru_cache(maxsize=1)
+def _load_cached_token(path, mtime):
+    """Parses the token file. Keyed on mtime so the file is only re-read after it changes."""
+    with open(path, 'rb') as f:
+        try:
+            return orjson.loads(f.read())
+        except orjson.JSONDecodeError:
+            return {}
+
+
+def _backoff_delay(attempt, retry_after=None):
+    """Seconds to wait before retrying a 429: the server's Retry-After if given, else exponential backoff.
+
+    Both are capped at MAX_RETRY_DELAY, so a huge Retry-After can't park the workers for hours.
+    """
+    try:
+        return min(MAX_RETRY_DELAY, max(0.0, float(retry_after)))
+    except (TypeError, ValueError):
+        return min(MAX_RETRY_DELAY, 2 ** attempt) + random.uniform(0, 1)
+
+
 class AsyncSiaClient:
     """An ASYNC client for the Spamhaus Intelligence API."""
 
-    def __init__(self, base_url, username, password, token_file):
+    def __init__(self, base_url, username, password, token_file, concurrency=20):
         self.base_url = base_url
+        self._cidr_url_fmt = f"{base_url}/api/intel/v1/byobject/cidr/{{dataset}}/{{mode}}/{{query_type}}/{{cidr}}"
+        self._live_params = {}
         self.username = username
         self.password = password
         self.token_file = token_file
         self.token = None
         self.token_expires = 0
+        self.auth_headers = {}
+        self.concurrency = concurrency
         self.session = None
+        self.limits_data = None
 
-    def initial_auth(self):
+    async def ensure_auth(self):
+        """(ASYNC) Makes sure the session exists and holds a valid bearer token."""
+        await self.create_session()
+        if self.token and time.time() < (self.token_expires - 60): return
         if os.path.exists(self.token_file):
-            with open(self.token_file, 'r') as f:
-                try:
-                    data = json.load(f)
-                    if time.time() < (data.get('expires', 0) - 60):
-                        self.token = data.get('token')
-                        logger.info("Loaded valid token from file.")
-                        return
-                except json.JSONDecodeError: pass
+            data = _load_cached_token(self.token_file, os.path.getmtime(self.token_file))
+            if time.time() < (data.get('expires', 0) - 60):
+                self._set_token(data.get('token'), data.get('expires', 0))
+                logger.info("Loaded valid token from file.")
+                return
         logger.info("Requesting a new authentication token...")
         login_url = f"{self.base_url}/api/v1/login"
         creds = {"username": self.username, "password": self.password, "realm": "intel"}
         try:
-            response = requests.post(login_url, json=creds)
-            if response.status_code == 200:
-                data = response.json()
-                self.token = data.get('token')
-                self.token_expires = data.get('expires', 0)
-                with open(self.token_file, 'w') as f: json.dump({'token': self.token, 'expires': self.token_expires}, f)
-                logger.info("Authentication successful, token saved.")
-            else:
-                logger.critical(f"Authentication failed: {response.text}"); sys.exit(1)
-        except requests.exceptions.RequestException as e:
-            logger.critical(f"Network error during auth: {e}"); sys.exit(1)
-
-    def check_limits_sync(self):
-        if not self.token: self.initial_auth()
-        headers = {"Authorization": f"Bearer {self.token}"}
+            async with self.session.post(login_url, json=creds) as response:
+                if response.status != 200:
+                    logger.critical(f"Authentication failed: {await response.text()}")
+                    await self.close_session(); sys.exit(1)
+                data = orjson.loads(await response.read())
+        except aiohttp.ClientError as e:
+            logger.critical(f"Network error during auth: {e}")
+            await self.close_session(); sys.exit(1)
+        self._set_token(data.get('token'), data.get('expires', 0))
+        with open(self.token_file, 'wb') as f: f.write(orjson.dumps({'token': self.token, 'expires': self.token_expires}))
+        logger.info("Authentication successful, token saved.")
+
+    def _set_token(self, token, expires):
+        self.token = token
+        self.token_expires = expires
+        self.auth_headers = {"Authorization": f"Bearer {token}"}
+
+    async def fetch_limits(self):
+        """(ASYNC) Fetches the account's limits once per run. Returns None if they are unavailable."""
+        if self.limits_data is not None: return self.limits_data
+        await self.ensure_auth()
         url = f"{self.base_url}/api/intel/v1/limits"
-        print("\n--- Checking Account Status ---")
         try:
-            response = requests.get(url, headers=headers)
-            if response.status_code != 200:
-                logger.warning(f"Could not retrieve limits: Status {response.status_code}"); return
-            limits_data = response.json()
-            account = limits_data.get('account', {})
-            limits = limits_data.get('limits', {})
-            current = limits_data.get('current', {})
-            report = "ACCOUNT:\n"
-            report += f"  - User: {account.get('usr', 'N/A')}\n  - Subscription ID: {account.get('sub', 'N/A')}\n\n"
-            report += "GLOBAL LIMITS:\n"
-            report += f"  - Allowed Datasets: {limits.get('ads', 'N/A')}\n  - Access Level: {limits.get('trs', 'N/A')}\n"
-            report += f"  - Queries/Month (Soft Limit): {limits.get('qms', 'N/A')}\n  - Queries/Month (Hard Limit): {limits.get('qmh', 'N/A')}\n\n"
-            report += "RATE LIMITS (Per Time Period):\n"
-            report += f"  - Per Second: {limits.get('rl_qps', 'N/A')}\n  - Per Minute: {limits.get('rl_qpm', 'N/A')}\n  - Per Hour:   {limits.get('rl_qph', 'N/A')}\n\n"
-            report += "CURRENT USAGE:\n"
-            report += f"  - This Month: {current.get('qpm', 'N/A')}\n  - Today:      {current.get('qpd', 'N/A')}\n"
-            print(report); print("---------------------------------\n")
-        except requests.exceptions.RequestException as e:
-            logger.error(f"Network error checking limits: {e}")
+            async with self.session.get(url, headers=self.auth_headers) as response:
+                if response.status != 200:
+                    logger.warning(f"Could not retrieve limits: Status {response.status}"); return None
+                self.limits_data = orjson.loads(await response.read())
+        except (aiohttp.ClientError, orjson.JSONDecodeError) as e:
+            logger.error(f"Network error checking limits: {e}"); return None
+        return self.limits_data
+
+    async def check_limits(self):
+        """(ASYNC) Prints the account's limits and current usage. Returns the 'limits' section."""
+        print("\n--- Checking Account Status ---")
+        limits_data = await self.fetch_limits()
+        if limits_data is None: return {}
+        account = limits_data.get('account', {})
+        limits = limits_data.get('limits', {})
+        current = limits_data.get('current', {})
+        parts = [
+            "ACCOUNT:",
+            f"  - User: {account.get('usr', 'N/A')}",
+            f"  - Subscription ID: {account.get('sub', 'N/A')}",
+            "",
+            "GLOBAL LIMITS:",
+            f"  - Allowed Datasets: {limits.get('ads', 'N/A')}",
+            f"  - Access Level: {limits.get('trs', 'N/A')}",
+            f"  - Queries/Month (Soft Limit): {limits.get('qms', 'N/A')}",
+            f"  - Queries/Month (Hard Limit): {limits.get('qmh', 'N/A')}",
+            "",
+            "RATE LIMITS (Per Time Period):",
+            f"  - Per Second: {limits.get('rl_qps', 'N/A')}",
+            f"  - Per Minute: {limits.get('rl_qpm', 'N/A')}",
+            f"  - Per Hour:   {limits.get('rl_qph', 'N/A')}",
+            "",
+            "CURRENT USAGE:",
+            f"  - This Month: {current.get('qpm', 'N/A')}",
+            f"  - Today:      {current.get('qpd', 'N/A')}",
+            "",
+        ]
+        print("\n".join(parts)); print("---------------------------------\n")
+        return limits
 
     async def create_session(self):
-        if self.token is None: self.initial_auth()
-        headers = {"Authorization": f"Bearer {self.token}"}
-        self.session = aiohttp.ClientSession(headers=headers)
+        """(ASYNC) Creates the single HTTP session used for login, limits and CIDR queries."""
+        if self.session is None:
+            # Cap the pool at the worker count so the scan reuses keep-alive connections
+            # instead of opening (and TLS-handshaking) new sockets under bursts.
+            connector = aiohttp.TCPConnector(limit=self.concurrency, limit_per_host=self.concurrency,
+                                             ttl_dns_cache=600, keepalive_timeout=75)
+            self.session = aiohttp.ClientSession(connector=connector)
 
     async def close_session(self):
-        if self.session: await self.session.close()
+        if self.session: await self.session.close(); self.session = None
 
     async def get_cidr_listings(self, cidr_str, dataset, mode, limit, since=None, until=None):
-        """(ASYNC) Gets listings within a CIDR. Supports both LIVE and HISTORY modes."""
+        """(ASYNC) Gets listings within a CIDR. Supports both LIVE and HISTORY modes.
+
+        Returns None on a network error or unexpected status. Raises RateLimitExceeded when the
+        query is still getting 429s after the retries, which usually means the quota is spent.
+        """
         if since and until:
             query_type = "history"
             params = {"limit": limit, "since": since, "until": until}
         else:
             query_type = "live"
-            params = {"limit": limit}
-        url = f"{self.base_url}/api/intel/v1/byobject/cidr/{dataset}/{mode}/{query_type}/{cidr_str}"
-        try:
-            async with self.session.get(url, params=params) as response:
-                if response.status == 200: return await response.json()
-                if response.status == 404: return {"code": 404, "results": []}
-                if response.status == 429: logger.critical("429 - TOO MANY REQUESTS. API limit hit."); sys.exit(1)
-                logger.warning(f"API returned status {response.status} for CIDR {cidr_str}"); return None
-        except aiohttp.ClientError as e:
-            logger.error(f"Network client error querying {cidr_str}: {e}"); return None
\ No newline at end of file
+            # LIVE queries all share the same params, so the dict is reused rather than rebuilt per call.
+            if self._live_params.get("limit") != limit: self._live_params = {"limit": limit}
+            params = self._live_params
+        url = self._cidr_url_fmt.format_map({"dataset": dataset, "mode": mode, "query_type": query_type, "cidr": cidr_str})
+        for attempt in range(MAX_RATE_LIMIT_RETRIES + 1):
+            try:
+                async with self.session.get(url, params=params, headers=self.auth_headers) as response:
+                    if response.status == 200: return orjson.loads(await response.read())
+                    if response.status == 404: return {"code": 404, "results": []}
+                    if response.status != 429:
+                        logger.warning(f"API returned status {response.status} for CIDR {cidr_str}"); return None
+                    retry_after = response.headers.get('Retry-After')
+            except (aiohttp.ClientError, orjson.JSONDecodeError) as e:
+                logger.error(f"Network client error querying {cidr_str}: {e}"); return None
+            if attempt == MAX_RATE_LIMIT_RETRIES: break
+            delay = _backoff_delay(attempt, retry_after)
+            logger.warning(f"429 - TOO MANY REQUESTS for CIDR {cidr_str}. Retrying in {delay:.1f}s "
+                           f"({attempt + 1}/{MAX_RATE_LIMIT_RETRIES}).")
+            await asyncio.sleep(delay)
+        raise RateLimitExceeded(f"CIDR {cidr_str} is still rate-limited after {MAX_RATE_LIMIT_RETRIES} retries.")
@@ -4,124 +4,257 @@ import logging
 import asyncio
 import ipaddress
 import time
-import aiosqlite
+import collections
+from aiolimiter import AsyncLimiter
 from . import database
+from .client import RateLimitExceeded
 
 logger = logging.getLogger(__name__)
 
-# A constant list of all DB columns to ensure consistency.
-DB_COLUMNS = [
-    'dataset', 'ipaddress', 'asn', 'cc', 'listed', 'seen', 'valid_until', 'rule',
-    'botname', 'botname_malpedia', 'dstport', 'heuristic', 'lat', 'lon',
-    'protocol', 'srcip', 'domain', 'helo', 'detection'
-]
+# Writes from this many scanned subnets are committed in one transaction; a partial batch
+# is flushed once it has been waiting this many seconds.
+WRITE_BATCH_SIZE = 64
+WRITE_FLUSH_INTERVAL = 5.0
+# Primary keys of recently written hits remembered by the writer, so repeats across batches
+# are dropped before they reach SQLite.
+RECENT_KEYS_LIMIT = 100_000
+
+
+def _parse_v4_cidr(cidr_str):
+    """Parses a plain 'a.b.c.d[/nn]' IPv4 network into (network_int, prefixlen).
+
+    Returns None for anything else (IPv6, odd formatting, host bits set) so the caller can
+    fall back to ipaddress, which also produces the proper error for invalid input.
+    """
+    addr, sep, prefix = cidr_str.partition('/')
+    octets = addr.split('.')
+    if len(octets) != 4: return None
+    for octet in octets:
+        if not (octet.isascii() and octet.isdigit() and len(octet) <= 3) or (octet[0] == '0' and octet != '0'): return None
+    if sep and not (prefix.isascii() and prefix.isdigit() and len(prefix) <= 2): return None
+    o1, o2, o3, o4 = map(int, octets)
+    prefixlen = int(prefix) if sep else 32
+    if max(o1, o2, o3, o4) > 255 or prefixlen > 32: return None
+    network_int = (o1 << 24) | (o2 << 16) | (o3 << 8) | o4
+    if network_int & ((1 << (32 - prefixlen)) - 1): return None
+    return network_int, prefixlen
+
+
+def _iter_subnets(cidr_str, new_prefix=24):
+    """Yields the /new_prefix blocks of a target as strings (or the target itself if it is no larger).
+
+    Plain IPv4 targets are split arithmetically without building an IPv4Network per block;
+    anything else goes through ipaddress, which raises ValueError for invalid input.
+    """
+    parsed = _parse_v4_cidr(cidr_str)
+    if parsed is None:
+        network = ipaddress.ip_network(cidr_str)
+        subnets = network.subnets(new_prefix=new_prefix) if network.prefixlen < new_prefix else [network]
+        for subnet in subnets: yield str(subnet)
+        return
+    network_int, prefixlen = parsed
+    if prefixlen >= new_prefix:
+        yield f"{_format_v4(network_int)}/{prefixlen}"
+        return
+    for base in range(network_int, network_int + (1 << (32 - prefixlen)), 1 << (32 - new_prefix)):
+        yield f"{_format_v4(base)}/{new_prefix}"
+
+
+def _format_v4(addr_int):
+    return f"{addr_int >> 24}.{(addr_int >> 16) & 0xff}.{(addr_int >> 8) & 0xff}.{addr_int & 0xff}"
 
 
 class AsyncCollector:
-    def __init__(self, client, target_file, db_path, concurrency, params):
+    def __init__(self, client, target_file, db_path, concurrency, params, split_prefix=24):
         self.client = client
         self.target_file = target_file
         self.db_path = db_path
-        self.semaphore = asyncio.Semaphore(concurrency)
-        self.db_lock = asyncio.Lock()
+        # Exactly this many workers consume the queue, which is what caps in-flight queries.
+        self.concurrency = int(concurrency)
         self.params = params
-        self.queue = asyncio.Queue()
+        self.split_prefix = int(split_prefix)
+        # Bounded so the producer only runs a few subnets ahead of the workers instead of
+        # expanding every target (a /8 is 65k subnets) into memory up front.
+        self.queue = asyncio.Queue(maxsize=self.concurrency * 4)
+        # Set once the producer has queued every subnet; workers exit when it is set and the queue is empty.
+        self.producer_done = asyncio.Event()
+        self.qps_limiter = None
+        self.qpm_limiter = None
+        self.write_queue = asyncio.Queue()
+
+    async def _configure_rate_limits(self):
+        """Sizes the per-second and per-minute limiters from the account's reported rate limits."""
+        limits_data = await self.client.fetch_limits() or {}
+        limits = limits_data.get('limits', {})
+        if limits.get('rl_qps'): self.qps_limiter = AsyncLimiter(limits['rl_qps'], 1)
+        if limits.get('rl_qpm'): self.qpm_limiter = AsyncLimiter(limits['rl_qpm'], 60)
+        logger.info(f"Rate limits: {limits.get('rl_qps', 'unlimited')}/s, {limits.get('rl_qpm', 'unlimited')}/min.")
+
+    async def _throttle(self):
+        """Waits until both rate limiters allow another query."""
+        if self.qps_limiter: await self.qps_limiter.acquire()
+        if self.qpm_limiter: await self.qpm_limiter.acquire()
+
+    async def _writer(self, insert_sql):
+        """The scan's only database writer: drains write_queue and commits the jobs in batches.
+
+        Each job is (subnet_str, hits, scanned_at); scanned_at is None when the subnet should not
+        be logged in the live cache. A None job flushes what is pending and stops the writer.
+        If the scan is cancelled instead, everything already queued is committed before stopping.
+        Batches are written on a plain sqlite3 connection in a worker thread, one hop per batch.
+        """
+        pending_hits, pending_scanned, pending_subnets = [], [], 0
+        recent_keys = collections.OrderedDict()
+
+        def add(job):
+            nonlocal pending_subnets
+            subnet_str, hits, scanned_at = job
+            pending_hits.extend(hits)
+            if scanned_at is not None: pending_scanned.append((subnet_str, scanned_at))
+            pending_subnets += 1
+
+        async def flush():
+            nonlocal pending_hits, pending_scanned, pending_subnets
+            if not pending_subnets: return
+            # Drop duplicate (ipaddress, listed, rule) keys in Python, keeping the first occurrence
+            # like INSERT OR IGNORE does; OR IGNORE stays as the backstop.
+            fresh = {}
+            for hit in pending_hits:
+                key = (hit.get('ipaddress'), hit.get('listed'), hit.get('rule'))
+                if key not in recent_keys: fresh.setdefault(key, hit)
+            scanned, subnets = pending_scanned, pending_subnets
+            pending_hits, pending_scanned, pending_subnets = [], [], 0
+            write = asyncio.ensure_future(
+                asyncio.to_thread(database.write_batch, conn, insert_sql, list(fresh.values()), scanned))
+            try:
+                count = await asyncio.shield(write)
+            except asyncio.CancelledError:
+                # Let the batch already in the thread finish before anything else uses the connection.
+                await write; raise
+            for key in fresh: recent_keys[key] = None
+            while len(recent_keys) > RECENT_KEYS_LIMIT: recent_keys.popitem(last=False)
+            logger.info(f"Saved {count} listings from {subnets} subnets.")
+
+        conn = await asyncio.to_thread(database.connect, self.db_path, isolation_level=None, check_same_thread=False)
+        try:
+            deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+            while True:
+                # asyncio.timeout rather than wait_for: on 3.11 wait_for can swallow a cancellation.
+                try:
+                    async with asyncio.timeout(max(0, deadline - time.monotonic())):
+                        job = await self.write_queue.get()
+                except TimeoutError:
+                    await flush(); deadline = time.monotonic() + WRITE_FLUSH_INTERVAL; continue
+                if job is None: break
+                add(job)
+                if pending_subnets >= WRITE_BATCH_SIZE:
+                    await flush(); deadline = time.monotonic() + WRITE_FLUSH_INTERVAL
+            await flush()
+        except asyncio.CancelledError:
+            # The scan failed or was interrupted: commit what the workers already delivered.
+            while not self.write_queue.empty():
+                job = self.write_queue.get_nowait()
+                if job is not None: add(job)
+            await flush()
+            raise
+        finally:
+            await asyncio.to_thread(conn.close)
+
+    async def _stop_writer_after(self, tasks):
+        """Sends the writer its stop job once the producer and every worker have finished."""
+        await asyncio.wait(tasks)
+        self.write_queue.put_nowait(None)
+
+    async def _next_subnet(self):
+        """Returns the next queued subnet, or None once the producer is done and the queue is drained."""
+        while True:
+            try:
+                return self.queue.get_nowait()
+            except asyncio.QueueEmpty:
+                if self.producer_done.is_set(): return None
+            try:
+                return await asyncio.wait_for(self.queue.get(), timeout=0.1)
+            except asyncio.TimeoutError:
+                continue
+
+    def _read_targets(self):
+        """Reads the target file in one bulk read, skipping blank lines and comments."""
+        with open(self.target_file, 'rb') as f:
+            lines = f.read().splitlines()
+        return [line.decode().strip() for line in lines if line.strip() and not line.lstrip().startswith(b'#')]
 
     # --- Live Scan Methods ---
     async def _live_producer(self):
         logger.info("Producer started: Reading and splitting target CIDRs for LIVE scan.")
-        async with aiosqlite.connect(self.db_path) as db:
-            with open(self.target_file, 'r') as f:
-                for line in f:
-                    cidr_str = line.strip()
-                    if not cidr_str or cidr_str.startswith('#'): continue
-                    try:
-                        network = ipaddress.ip_network(cidr_str)
-                        subnets = list(network.subnets(new_prefix=24)) if network.prefixlen < 24 else [network]
-                        for subnet in subnets:
-                            subnet_str = str(subnet)
-                            async with self.db_lock:
-                                if not await database.check_if_scanned(db, subnet_str):
-                                    await self.queue.put(subnet_str)
-                                else:
-                                    logger.debug(f"[CACHE HIT] {subnet_str} already scanned. Skipping.")
-                    except ValueError:
-                        logger.error(f"Invalid CIDR format: {cidr_str}")
-        for _ in range(self.semaphore._value): await self.queue.put(None)
+        scanned = await asyncio.to_thread(database.load_scanned_cidrs, self.db_path)
+        logger.info(f"Loaded {len(scanned)} previously scanned CIDRs from the cache.")
+        for cidr_str in self._read_targets():
+            try:
+                for subnet_str in _iter_subnets(cidr_str, self.split_prefix):
+                    if subnet_str not in scanned:
+                        scanned.add(subnet_str)
+                        await self.queue.put(subnet_str)
+                    else:
+                        logger.debug(f"[CACHE HIT] {subnet_str} already scanned. Skipping.")
+            except ValueError:
+                logger.error(f"Invalid CIDR format: {cidr_str}")
+        self.producer_done.set()
 
     async def _live_worker(self, name):
-        async with aiosqlite.connect(self.db_path) as db:
-            while True:
-                subnet_str = await self.queue.get()
-                if subnet_str is None: self.queue.put_nowait(None); break
-                async with self.semaphore:
-                    logger.info(f"[{name}] Querying LIVE for {subnet_str}...")
-                    response = await self.client.get_cidr_listings(cidr_str=subnet_str, **self.params)
-
-                    if response and response.get('results'):
-                        hits = response.get('results', [])
-                        if len(hits) >= self.params['limit']:
-                            logger.warning(
-                                f"CIDR {subnet_str} hit the LIVE query limit of {self.params['limit']}. Some data may be missing.")
-
-                        # FIX: Ensure all required DB columns exist in each hit dictionary
-                        for hit in hits:
-                            for key in DB_COLUMNS: hit.setdefault(key, None)
-
-                        async with self.db_lock:
-                            count = await database.insert_hits(db, hits)
-                            logger.info(f"[{name}]   -> Found and saved {count} LIVE listings for {subnet_str}.")
-
-                    async with self.db_lock:
-                        await database.mark_as_scanned(db, subnet_str, int(time.time()))
-                self.queue.task_done()
+        while True:
+            subnet_str = await self._next_subnet()
+            if subnet_str is None: break
+            logger.info(f"[{name}] Querying LIVE for {subnet_str}...")
+            await self._throttle()
+            response = await self.client.get_cidr_listings(cidr_str=subnet_str, **self.params)
+
+            hits = (response.get('results') if response else None) or []
+            if hits:
+                if len(hits) >= self.params['limit']:
+                    logger.warning(
+                        f"CIDR {subnet_str} hit the LIVE query limit of {self.params['limit']}. Some data may be missing.")
+                logger.info(f"[{name}]   -> Found {len(hits)} LIVE listings for {subnet_str}.")
+
+            # A failed query (None) is not logged as scanned, so the next live run retries the subnet.
+            scanned_at = int(time.time()) if response is not None else None
+            await self.write_queue.put((subnet_str, hits, scanned_at))
+            self.queue.task_done()
         logger.info(f"[{name}] live worker finished.")
 
     # --- History Scan Methods ---
     async def _history_producer(self):
         logger.info("Producer started: Reading and splitting target CIDRs for HISTORY scan.")
-        with open(self.target_file, 'r') as f:
-            for line in f:
-                cidr_str = line.strip()
-                if not cidr_str or cidr_str.startswith('#'): continue
-                try:
-                    network = ipaddress.ip_network(cidr_str)
-                    subnets = list(network.subnets(new_prefix=24)) if network.prefixlen < 24 else [network]
-                    for subnet in subnets: await self.queue.put(str(subnet))
-                except ValueError:
-                    logger.error(f"Invalid CIDR format: {cidr_str}")
-        for _ in range(self.semaphore._value): await self.queue.put(None)
+        for cidr_str in self._read_targets():
+            try:
+                for subnet_str in _iter_subnets(cidr_str, self.split_prefix): await self.queue.put(subnet_str)
+            except ValueError:
+                logger.error(f"Invalid CIDR format: {cidr_str}")
+        self.producer_done.set()
 
     async def _history_worker(self, name, since_ts, until_ts):
-        async with aiosqlite.connect(self.db_path) as db:
-            while True:
-                subnet_str = await self.queue.get()
-                if subnet_str is None: self.queue.put_nowait(None); break
-                async with self.semaphore:
-                    logger.info(f"[{name}] Querying HISTORY for {subnet_str}...")
-                    response = await self.client.get_cidr_listings(cidr_str=subnet_str, since=since_ts, until=until_ts,
-                                                                   **self.params)
-
-                    if response and response.get('results'):
-                        hits = response.get('results', [])
-                        if len(hits) >= self.params['limit']:
-                            logger.warning(
-                                f"CIDR {subnet_str} hit the HISTORY query limit of {self.params['limit']}. Some historical data may be missing.")
-
-                        # FIX: Ensure all required DB columns exist in each hit dictionary
-                        for hit in hits:
-                            for key in DB_COLUMNS: hit.setdefault(key, None)
-
-                        async with self.db_lock:
-                            count = await database.insert_history_hits(db, hits)
-                            logger.info(f"[{name}]   -> Found and saved {count} HISTORICAL listings for {subnet_str}.")
-                self.queue.task_done()
+        while True:
+            subnet_str = await self._next_subnet()
+            if subnet_str is None: break
+            logger.info(f"[{name}] Querying HISTORY for {subnet_str}...")
+            await self._throttle()
+            response = await self.client.get_cidr_listings(cidr_str=subnet_str, since=since_ts, until=until_ts,
+                                                           **self.params)
+
+            hits = response.get('results') if response else None
+            if hits:
+                if len(hits) >= self.params['limit']:
+                    logger.warning(
+                        f"CIDR {subnet_str} hit the HISTORY query limit of {self.params['limit']}. Some historical data may be missing.")
+                logger.info(f"[{name}]   -> Found {len(hits)} HISTORICAL listings for {subnet_str}.")
+                await self.write_queue.put((subnet_str, hits, None))
+            self.queue.task_done()
         logger.info(f"[{name}] history worker finished.")
 
     # --- Main Orchestrator ---
     async def run_scan(self, history_days=None):
-        await self.client.create_session()
+        await self.client.ensure_auth()
         try:
+            await self._configure_rate_limits()
             start_time = time.time()
             if history_days:
                 logger.info(f"--- Starting History Scan (Last {history_days} Days) ---")
@@ -129,13 +262,35 @@ class AsyncCollector:
                 since_ts = until_ts - (history_days * 86400)
                 producer = self._history_producer()
                 workers = [self._history_worker(f"Worker-{i + 1}", since_ts, until_ts) for i in
-                           range(self.semaphore._value)]
+                           range(self.concurrency)]
             else:
                 logger.info("--- Starting Live Scan ---")
                 producer = self._live_producer()
-                workers = [self._live_worker(f"Worker-{i + 1}") for i in range(self.semaphore._value)]
+                workers = [self._live_worker(f"Worker-{i + 1}") for i in range(self.concurrency)]
 
-            await asyncio.gather(asyncio.create_task(producer), *[asyncio.create_task(w) for w in workers])
+            insert_sql = database.INSERT_HISTORY_HITS_SQL if history_days else database.INSERT_HITS_SQL
+            self.producer_done.clear()
+            try:
+                async with asyncio.TaskGroup() as tg:
+                    # The writer is part of the group, so a database error cancels the producer and
+                    # workers at once instead of letting them query the API for results that can't
+                    # be saved. A worker failure or Ctrl-C cancels the writer, which commits what
+                    # was already fetched before stopping.
+                    tg.create_task(self._writer(insert_sql))
+                    fetchers = [tg.create_task(producer)] + [tg.create_task(worker) for worker in workers]
+                    tg.create_task(self._stop_writer_after(fetchers))
+            except* Exception as eg:
+                # Re-raise the failing task's own error instead of the TaskGroup's ExceptionGroup wrapper.
+                error, *others = eg.exceptions
+                rate_limited = eg.subgroup(RateLimitExceeded)
+                if rate_limited:
+                    # Out of quota: stop rather than burn retries on every remaining target. Subnets
+                    # not yet queried were never logged as scanned, so a later run picks them up.
+                    logger.critical(f"{rate_limited.exceptions[0]} Stopping the scan; re-run later to resume.")
+                    raise SystemExit(1) from None
+                for other in others: logger.error(f"Another scan task also failed: {other!r}")
+                logger.error(f"Scan aborted: {error!r}")
+                raise error from None
             logger.info(f"✅ Scan finished in {time.time() - start_time:.2f} seconds.")
         finally:
             logger.info("Closing network session...")
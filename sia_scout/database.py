@@ -1,13 +1,65 @@
 # FILE: sia_scout/database.py
 
 import logging
+import sqlite3
 import aiosqlite
 
 logger = logging.getLogger(__name__)
 
+# A constant list of all DB columns to ensure consistency.
+DB_COLUMNS = [
+    'dataset', 'ipaddress', 'asn', 'cc', 'listed', 'seen', 'valid_until', 'rule',
+    'botname', 'botname_malpedia', 'dstport', 'heuristic', 'lat', 'lon',
+    'protocol', 'srcip', 'domain', 'helo', 'detection'
+]
+
+# Positional INSERT statements, built once. Rows are bound as tuples in DB_COLUMNS order, and
+# reusing the identical SQL string lets sqlite3 serve every batch from its statement cache.
+_INSERT_SQL = "INSERT OR IGNORE INTO {{table}} ({columns}) VALUES ({placeholders})".format(
+    columns=", ".join(DB_COLUMNS), placeholders=", ".join("?" * len(DB_COLUMNS)))
+INSERT_HITS_SQL = _INSERT_SQL.format(table="hits")
+INSERT_HISTORY_HITS_SQL = _INSERT_SQL.format(table="history_hits")
+# OR IGNORE: a CIDR logged by a concurrent scan must not fail (and roll back) the whole batch.
+INSERT_SCANNED_SQL = "INSERT OR IGNORE INTO scanned_cidrs (cidr, scanned_at) VALUES (?, ?)"
+
+
+def _hit_to_row(hit):
+    """Turns an API hit dict into a row tuple in DB_COLUMNS order; missing fields become NULL."""
+    return tuple(map(hit.get, DB_COLUMNS))
+
+
+# WAL lets the analyzer read while a scan is writing; NORMAL sync is safe under WAL
+# and avoids an fsync on every commit. Reads are served from a 256MB memory map
+# and a 64MB page cache. A connection that finds the database locked waits up to
+# 30s instead of failing immediately.
+CONNECTION_PRAGMAS = [
+    "PRAGMA journal_mode=WAL",
+    "PRAGMA synchronous=NORMAL",
+    "PRAGMA busy_timeout=30000",
+    "PRAGMA temp_store=MEMORY",
+    "PRAGMA mmap_size=268435456",
+    "PRAGMA cache_size=-65536",
+]
+
+
+async def configure_connection(db):
+    """Applies the per-connection PRAGMAs to an open aiosqlite connection."""
+    for pragma in CONNECTION_PRAGMAS:
+        await db.execute(pragma)
+
+
+def connect(db_path, **kwargs):
+    """(SYNC) Opens a plain sqlite3 connection with the per-connection PRAGMAs applied."""
+    conn = sqlite3.connect(db_path, **kwargs)
+    for pragma in CONNECTION_PRAGMAS:
+        conn.execute(pragma)
+    return conn
+
+
 async def initialize_database(db_path):
     """Creates the necessary tables in the database if they don't exist."""
     async with aiosqlite.connect(db_path) as db:
+        await configure_connection(db)
         # Table for "live" threat listings
         await db.execute("""
             CREATE TABLE IF NOT EXISTS hits (
@@ -30,56 +82,43 @@ async def initialize_database(db_path):
             )
         """)
 
-        # Table to log which /24 CIDRs have been scanned for LIVE data
+        # Table to log which CIDR blocks have been scanned for LIVE data
         await db.execute("""
             CREATE TABLE IF NOT EXISTS scanned_cidrs (
                 cidr TEXT PRIMARY KEY,
                 scanned_at INTEGER
             )
         """)
+
+        # Indexes backing the analyzer's and visualizer's GROUP BY queries on both hit tables
+        for table in ("hits", "history_hits"):
+            for column in ("detection", "botname", "asn", "heuristic", "dataset", "listed"):
+                await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_{column} ON {table}({column})")
+            # Partial index: the C2 domain report only ever looks at XBL listings
+            await db.execute(f"CREATE INDEX IF NOT EXISTS idx_{table}_xbl_domain ON {table}(domain) WHERE dataset = 'XBL'")
         await db.commit()
     logger.info(f"Database initialized at {db_path}")
 
-async def check_if_scanned(db, cidr_str):
-    """Checks if a CIDR has already been logged as scanned in the live cache."""
-    async with db.execute("SELECT 1 FROM scanned_cidrs WHERE cidr = ?", (cidr_str,)) as cursor:
-        return await cursor.fetchone() is not None
-
-async def insert_hits(db, hits):
-    """Inserts a list of LIVE hit records into the 'hits' table."""
-    if not hits: return 0
-    await db.executemany("""
-        INSERT OR IGNORE INTO hits (
-            dataset, ipaddress, asn, cc, listed, seen, valid_until, rule,
-            botname, botname_malpedia, dstport, heuristic, lat, lon,
-            protocol, srcip, domain, helo, detection
-        ) VALUES (
-            :dataset, :ipaddress, :asn, :cc, :listed, :seen, :valid_until, :rule,
-            :botname, :botname_malpedia, :dstport, :heuristic, :lat, :lon,
-            :protocol, :srcip, :domain, :helo, :detection
-        )
-    """, hits)
-    await db.commit()
-    return len(hits)
+def load_scanned_cidrs(db_path):
+    """(SYNC) Returns the set of CIDRs already logged as scanned in the live cache."""
+    conn = connect(db_path)
+    try:
+        return {row[0] for row in conn.execute("SELECT cidr FROM scanned_cidrs")}
+    finally:
+        conn.close()
 
-async def insert_history_hits(db, hits):
-    """Inserts a list of HISTORICAL hit records into the 'history_hits' table."""
-    if not hits: return 0
-    await db.executemany("""
-        INSERT OR IGNORE INTO history_hits (
-            dataset, ipaddress, asn, cc, listed, seen, valid_until, rule,
-            botname, botname_malpedia, dstport, heuristic, lat, lon,
-            protocol, srcip, domain, helo, detection
-        ) VALUES (
-            :dataset, :ipaddress, :asn, :cc, :listed, :seen, :valid_until, :rule,
-            :botname, :botname_malpedia, :dstport, :heuristic, :lat, :lon,
-            :protocol, :srcip, :domain, :helo, :detection
-        )
-    """, hits)
-    await db.commit()
-    return len(hits)
+def write_batch(conn, insert_sql, hits, scanned):
+    """(SYNC) Writes a batch of hits and scanned-CIDR entries in a single transaction.
 
-async def mark_as_scanned(db, cidr_str, timestamp):
-    """Marks a CIDR as scanned in the live cache table."""
-    await db.execute("INSERT INTO scanned_cidrs (cidr, scanned_at) VALUES (?, ?)", (cidr_str, timestamp))
-    await db.commit()
\ No newline at end of file
+    `conn` must be in autocommit mode (isolation_level=None) so the explicit BEGIN/COMMIT
+    here is the only transaction. Returns the number of hit records written.
+    """
+    conn.execute("BEGIN")
+    try:
+        conn.executemany(insert_sql, (_hit_to_row(hit) for hit in hits))
+        conn.executemany(INSERT_SCANNED_SQL, scanned)
+        conn.execute("COMMIT")
+    except BaseException:
+        conn.execute("ROLLBACK")
+        raise
+    return len(hits)
@@ -1,93 +1,218 @@
 # FILE: sia_scout/visualizer.py
 
 import logging
+import asyncio
+import functools
+import threading
+import types
+from concurrent.futures import ThreadPoolExecutor
+import numpy as np
 import pandas as pd
-import aiosqlite
-import matplotlib.pyplot as plt
-import seaborn as sns
+from . import database
 import os
 
-try:
-    from sia_scout.analyzer import _fetchall_pandas
-    aiosqlite.Cursor.execute_fetchall_pandas = _fetchall_pandas
-except ImportError:
-    async def _fetchall_pandas(self):
-        columns = [x[0] for x in self.description]
-        data = await self.fetchall()
-        return pd.DataFrame(data, columns=columns)
-    aiosqlite.Cursor.execute_fetchall_pandas = _fetchall_pandas
-
 logger = logging.getLogger(__name__)
 
+_PLOTTING_LOCK = threading.Lock()
+# Fast zlib level for the PNGs: several times quicker to encode for somewhat larger files.
+PNG_SAVE_KWARGS = {"compress_level": 1}
+# At most this many charts are drawn at once (one per live chart). The pool is shared by every
+# Visualizer; its threads start on first use and are joined at interpreter exit.
+PLOT_WORKERS = 2
+_PLOT_EXECUTOR = ThreadPoolExecutor(max_workers=PLOT_WORKERS, thread_name_prefix="plot")
+
+# The chart queries, kept as constants so a connection's statement cache reuses their compiled form.
+_Q_TOP_HEURISTICS = ("SELECT heuristic, COUNT(*) AS n FROM hits WHERE heuristic IS NOT NULL "
+                     "GROUP BY heuristic ORDER BY n DESC LIMIT 10")
+_Q_THREAT_COMPOSITION = "SELECT dataset, COUNT(*) AS n FROM hits WHERE dataset IS NOT NULL GROUP BY dataset ORDER BY n DESC"
+_Q_DAILY_HISTORY = ("SELECT listed / 86400 AS day, COUNT(*) AS n FROM history_hits WHERE listed IS NOT NULL "
+                    "GROUP BY day ORDER BY day")
+
+
+def _plotting():
+    """Returns the plotting toolkit, importing matplotlib and seaborn on first use.
+
+    Their imports are slow, so they are deferred until a chart is actually drawn. The first
+    call also applies the chart style, once; the plot threads only read the rcParams after it.
+    """
+    with _PLOTTING_LOCK:
+        return _load_plotting()
+
+
+@functools.lru_cache(maxsize=None)
+def _load_plotting():
+    import matplotlib
+    matplotlib.use("Agg", force=True)  # Headless: charts are only ever written to PNG files.
+    import matplotlib.style
+    import seaborn as sns
+    from matplotlib.figure import Figure
+    from matplotlib.patches import Circle
+    from matplotlib.backends.backend_agg import FigureCanvasAgg
+    matplotlib.style.use('seaborn-v0_8-whitegrid')
+    return types.SimpleNamespace(
+        sns=sns, Figure=Figure, Circle=Circle, FigureCanvasAgg=FigureCanvasAgg,
+        paired=sns.color_palette("Paired"),
+        default_subplot_params={k: matplotlib.rcParams[f"figure.subplot.{k}"]
+                                for k in ("left", "bottom", "right", "top", "wspace", "hspace")})
+
+
+@functools.lru_cache(maxsize=None)
+def _rocket_palette(n_colors):
+    return _plotting().sns.color_palette("rocket", n_colors)
+
+
 class Visualizer:
     def __init__(self, db_path, output_dir="output"):
         self.db_path = db_path
         self.output_dir = output_dir
         os.makedirs(self.output_dir, exist_ok=True)
+        self._conn = None
+        self._conn_depth = 0
+        self._figures = {}
+
+    async def __aenter__(self):
+        """Opens one connection that every query shares until the outermost `async with` exits."""
+        if self._conn_depth == 0:
+            self._conn = await asyncio.to_thread(self._connect, check_same_thread=False)
+        self._conn_depth += 1
+        return self
+
+    async def __aexit__(self, *exc_info):
+        self._conn_depth -= 1
+        if self._conn_depth == 0:
+            conn, self._conn = self._conn, None
+            await asyncio.to_thread(conn.close)
+
+    def _connect(self, **kwargs):
+        """(SYNC) Opens a read-only connection: the visualizer never writes, so query_only guards it."""
+        conn = database.connect(self.db_path, **kwargs)
+        conn.execute("PRAGMA query_only=1")
+        return conn
+
+    def _read_sql(self, query):
+        """(SYNC) Runs a query and returns the result as a DataFrame.
 
-    async def _load_dataframe(self, table_name="hits"):
-        logger.info(f"Loading data from database table '{table_name}'...")
+        Uses the shared connection inside `async with self`, otherwise a short-lived one.
+        """
+        if self._conn is not None: return pd.read_sql_query(query, self._conn)
+        conn = self._connect()
         try:
-            async with aiosqlite.connect(self.db_path) as db:
-                async with db.execute(f"SELECT * FROM {table_name}") as cursor:
-                    df = await cursor.execute_fetchall_pandas()
-            if not df.empty: logger.info(f"Successfully loaded {len(df)} records.")
-            return df
+            return pd.read_sql_query(query, conn)
+        finally:
+            conn.close()
+
+    async def _load_counts(self, query):
+        """Runs a `SELECT key, COUNT(*)` aggregation and returns the counts as a Series indexed by key."""
+        try:
+            df = await asyncio.to_thread(self._read_sql, query)
         except Exception as e:
-            logger.error(f"Could not load data for visualization: {e}"); return pd.DataFrame()
+            logger.error(f"Could not load data for visualization: {e}"); return pd.Series(dtype='int64')
+        return df.set_index(df.columns[0])[df.columns[1]]
 
-    async def plot_top_heuristics(self, df):
-        if 'heuristic' not in df.columns or df['heuristic'].isnull().all():
-            logger.warning("Skipping 'Top Heuristics' plot: 'heuristic' column is missing or empty."); return
-        logger.info("Generating 'Top Detection Heuristics' bar chart...")
-        plt.style.use('seaborn-v0_8-whitegrid'); fig, ax = plt.subplots(figsize=(10, 8))
-        top_items = df['heuristic'].value_counts().nlargest(10).sort_values(ascending=True)
-        top_items.plot(kind='barh', ax=ax, color=sns.color_palette("rocket", len(top_items)))
+    # Every chart only needs per-group counts, so SQLite does the counting and only the
+    # aggregated rows are transferred.
+    async def _load_heuristic_counts(self):
+        return await self._load_counts(_Q_TOP_HEURISTICS)
+
+    async def _load_dataset_counts(self):
+        return await self._load_counts(_Q_THREAT_COMPOSITION)
+
+    async def _load_daily_counts(self):
+        """Returns history listings per UTC day as a daily Series, with days without listings as 0."""
+        counts = await self._load_counts(_Q_DAILY_HISTORY)
+        if counts.empty: return counts
+        # Scatter the per-day counts into a dense day range; rows arrive sorted by day.
+        days = counts.index.to_numpy(dtype='int64'); first_day = days[0]
+        daily = np.zeros(days[-1] - first_day + 1, dtype='int64'); daily[days - first_day] = counts.to_numpy()
+        start = pd.to_datetime(first_day * 86400, unit='s')
+        return pd.Series(daily, index=pd.date_range(start, periods=len(daily), freq='D'))
+
+    def _render(self, draw, data, output_path):
+        """(SYNC) Builds a chart with `draw(data)` and saves it to output_path. Runs in a plot thread."""
+        fig = draw(data)
+        fig.tight_layout(); fig.canvas.print_figure(output_path, pil_kwargs=PNG_SAVE_KWARGS)
+
+    def _figure(self, name, figsize):
+        """Returns the chart's Agg figure, cleared, with fresh axes to draw on.
+
+        Each chart keeps one standalone figure and canvas (never registered with pyplot) for the
+        life of the Visualizer, so repeated runs skip rebuilding them. The axes are recreated
+        each time since pandas keeps per-axes plot state that cla() does not reset.
+        """
+        plotting = _plotting()
+        fig = self._figures.get(name)
+        if fig is None:
+            fig = self._figures[name] = plotting.Figure(figsize=figsize); plotting.FigureCanvasAgg(fig)
+        # tight_layout starts from the current margins, so restore the defaults for identical output.
+        fig.clear(); fig.subplots_adjust(**plotting.default_subplot_params)
+        return fig, fig.add_subplot()
+
+    def _draw_top_heuristics(self, heuristic_counts):
+        fig, ax = self._figure('top_heuristics', (10, 8))
+        top_items = heuristic_counts.iloc[::-1]  # Already sorted descending by the query; barh draws bottom-up.
+        top_items.plot(kind='barh', ax=ax, color=_rocket_palette(len(top_items)))
         ax.set_title('Top 10 Detection Heuristics', fontsize=16, pad=20)
         ax.set_xlabel('Number of Listings', fontsize=12); ax.set_ylabel('Heuristic Type', fontsize=12)
-        for index, value in enumerate(top_items): ax.text(value, index, f' {value}', va='center')
-        plt.tight_layout(); output_path = os.path.join(self.output_dir, "top_heuristics.png")
-        plt.savefig(output_path); logger.info(f"Chart saved to {output_path}"); plt.close(fig)
+        ax.bar_label(ax.containers[0], fmt='%d', padding=3)
+        return fig
+
+    def _draw_threat_composition(self, dataset_counts):
+        fig, ax = self._figure('threat_composition', (8, 8))
+        wedges, _, autotexts = ax.pie(dataset_counts, labels=dataset_counts.index, autopct='%1.1f%%', startangle=90, pctdistance=0.85, colors=_plotting().paired)
+        centre_circle = _plotting().Circle((0,0),0.70,fc='white'); ax.add_artist(centre_circle)
+        ax.axis('equal'); ax.set_title('Threat Composition by Dataset', fontsize=16, pad=20)
+        return fig
 
-    async def plot_threat_composition(self, df):
-        if 'dataset' not in df.columns:
+    def _draw_threats_over_time(self, daily_counts):
+        fig, ax = self._figure('threats_over_time', (12, 6))
+        daily_counts.plot(kind='line', ax=ax, marker='o', linestyle='-')
+        ax.set_title('Daily Threat Listings (Historical)', fontsize=16, pad=20)
+        ax.set_xlabel('Date', fontsize=12); ax.set_ylabel('Number of Listings', fontsize=12)
+        ax.tick_params(axis='x', labelrotation=45)
+        return fig
+
+    async def _plot(self, draw, data, filename):
+        """Renders a chart on the plot thread pool, keeping the event loop free."""
+        output_path = os.path.join(self.output_dir, filename)
+        await asyncio.get_running_loop().run_in_executor(_PLOT_EXECUTOR, self._render, draw, data, output_path)
+        logger.info(f"Chart saved to {output_path}")
+
+    async def plot_top_heuristics(self, heuristic_counts):
+        if heuristic_counts.empty:
+            logger.warning("Skipping 'Top Heuristics' plot: 'heuristic' column is missing or empty."); return
+        logger.info("Generating 'Top Detection Heuristics' bar chart...")
+        await self._plot(self._draw_top_heuristics, heuristic_counts, "top_heuristics.png")
+
+    async def plot_threat_composition(self, dataset_counts):
+        if dataset_counts.empty:
             logger.warning("Skipping 'Threat Composition' plot: 'dataset' column is missing."); return
         logger.info("Generating 'Threat Composition' donut chart...")
-        dataset_counts = df['dataset'].value_counts()
-        plt.style.use('seaborn-v0_8-whitegrid'); fig, ax = plt.subplots(figsize=(8, 8))
-        wedges, _, autotexts = ax.pie(dataset_counts, labels=dataset_counts.index, autopct='%1.1f%%', startangle=90, pctdistance=0.85, colors=sns.color_palette("Paired"))
-        centre_circle = plt.Circle((0,0),0.70,fc='white'); fig.gca().add_artist(centre_circle)
-        ax.axis('equal'); plt.title('Threat Composition by Dataset', fontsize=16, pad=20)
-        plt.tight_layout(); output_path = os.path.join(self.output_dir, "threat_composition.png")
-        plt.savefig(output_path); logger.info(f"Chart saved to {output_path}"); plt.close(fig)
-
-    async def plot_threats_over_time(self, df):
-        if 'listed' not in df.columns:
-            logger.warning("Skipping 'Threats Over Time' plot: 'listed' column is missing."); return
+        await self._plot(self._draw_threat_composition, dataset_counts, "threat_composition.png")
+
+    async def plot_threats_over_time(self, daily_counts):
         logger.info("Generating 'Threats Over Time' line chart...")
-        df['listed_date'] = pd.to_datetime(df['listed'], unit='s')
-        daily_counts = df.set_index('listed_date').resample('D').size()
         if len(daily_counts) < 2:
             logger.warning("Skipping 'Threats Over Time' plot: Not enough data for a trend line."); return
-        plt.style.use('seaborn-v0_8-whitegrid'); fig, ax = plt.subplots(figsize=(12, 6))
-        daily_counts.plot(kind='line', ax=ax, marker='o', linestyle='-')
-        ax.set_title('Daily Threat Listings (Historical)', fontsize=16, pad=20)
-        ax.set_xlabel('Date', fontsize=12); ax.set_ylabel('Number of Listings', fontsize=12)
-        plt.xticks(rotation=45); plt.tight_layout()
-        output_path = os.path.join(self.output_dir, "historical_threats_over_time.png")
-        plt.savefig(output_path); logger.info(f"Chart saved to {output_path}"); plt.close(fig)
+        await self._plot(self._draw_threats_over_time, daily_counts, "historical_threats_over_time.png")
 
     async def generate_all_visuals(self):
-        df = await self._load_dataframe(table_name="hits")
-        if df.empty: logger.error("No live data loaded. Aborting visualization."); return
+        logger.info("Aggregating data from database table 'hits'...")
+        async with self:
+            heuristic_counts = await self._load_heuristic_counts()
+            dataset_counts = await self._load_dataset_counts()
+        # Each chart skips itself when its own counts are empty; only abort when neither has data.
+        if heuristic_counts.empty and dataset_counts.empty:
+            logger.error("No live data loaded. Aborting visualization."); return
         logger.info("--- Starting Live Data Visualization Suite ---")
-        await self.plot_top_heuristics(df)
-        await self.plot_threat_composition(df)
+        # The two charts are independent, so they render side by side.
+        await asyncio.gather(self.plot_top_heuristics(heuristic_counts), self.plot_threat_composition(dataset_counts))
         logger.info("--- Live Data Visualization Suite Finished ---")
 
     async def generate_history_visuals(self):
-        df = await self._load_dataframe(table_name="history_hits")
-        if df.empty: logger.error("No historical data loaded. Aborting visualization."); return
+        logger.info("Aggregating data from database table 'history_hits'...")
+        async with self:
+            daily_counts = await self._load_daily_counts()
+        if daily_counts.empty: logger.error("No historical data loaded. Aborting visualization."); return
         logger.info("--- Starting Historical Data Visualization Suite ---")
-        await self.plot_threats_over_time(df)
+        await self.plot_threats_over_time(daily_counts)
         logger.info("--- Historical Data Visualization Suite Finished ---")
\ No newline at end of file